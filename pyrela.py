@@ -1,15 +1,35 @@
-from collections import defaultdict
+import asyncio
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+import concurrent.futures
+from contextlib import contextmanager
 from copy import copy
+import csv
+from functools import cmp_to_key, partial
+import heapq
+import io
+from itertools import islice
 import json
+import os
+import pickle
+import tempfile
+import threading
+import weakref
+
+
+# The number of tuples shown when a relation is printed.
+REPR_MAX_ROWS = 20
 
 
 class Relation:
     def __init__(self, attrs, tuples):
         n = len(attrs)
-        assert all(t for t in tuples if len(t) == n)
 
+        # tuples may be any iterable (including a generator), so we only walk
+        # it once, building the set as we go.
         self.attrs = tuple(attrs)
         self.tuples = {tuple(t) for t in tuples}
+        assert all(len(t) == n for t in self.tuples)
 
 
     @staticmethod
@@ -21,33 +41,52 @@ class Relation:
 
 
     def __repr__(self):
-        cols = range(len(self.attrs))
+        return self.to_string(max_rows=REPR_MAX_ROWS)
 
-        headings = [str(attr) for attr in self.attrs]
 
-        widths = [1 + max([len(str(t[i])) for t in self.tuples] + [len(headings[i])])
-                  for i in cols]
+    def to_string(self, max_rows=None, f=None):
+        # Renders the relation as a table.  If max_rows is given, only that
+        # many tuples are rendered, followed by a line giving the total number
+        # of tuples.  If f is given, lines are written to it as they are
+        # rendered and nothing is returned.  A full dump to f formats each cell
+        # twice (once for the widths, once for the output) so that the
+        # formatted cells never need to be held in memory at once.
+        if f is None:
+            f = io.StringIO()
+            self.to_string(max_rows=max_rows, f=f)
+            return f.getvalue()
 
-        lines = []
-
-        row = []
-        for i in cols:
-            e = ' ' + headings[i] + ' ' * (widths[i] - len(headings[i]))
-            row.append(e)
+        cols = range(len(self.attrs))
 
-        lines.append('|'.join(row))
+        headings = [str(attr) for attr in self.attrs]
 
-        lines.append('+'.join(['-' * (widths[i] + 1) for i in cols]))
+        if max_rows is None:
+            def rows():
+                return ([str(v) for v in t] for t in self.tuples)
+        else:
+            shown = [[str(v) for v in t] for t in islice(self.tuples, max_rows)]
+            def rows():
+                return shown
 
-        for t in self.tuples:
-            row = []
+        widths = [1 + len(heading) for heading in headings]
+        for row in rows():
             for i in cols:
-                e = ' ' + str(t[i]) + ' ' * (widths[i] - len(str(t[i])))
-                row.append(e)
+                widths[i] = max(widths[i], 1 + len(row[i]))
+
+        def write_row(row):
+            f.write('|'.join(' ' + row[i] + ' ' * (widths[i] - len(row[i])) for i in cols))
+            f.write('\n')
 
-            lines.append('|'.join(row))
+        f.write('\n')
+        write_row(headings)
+        f.write('+'.join(['-' * (widths[i] + 1) for i in cols]))
+        f.write('\n')
 
-        return '\n'.join([''] + lines + [''])
+        for row in rows():
+            write_row(row)
+
+        if max_rows is not None and len(self.tuples) > max_rows:
+            f.write('... ({} rows)\n'.format(len(self.tuples)))
 
 
     def __eq__(self, other):
@@ -58,6 +97,10 @@ class Relation:
         return len(self.tuples)
 
 
+    def analyze(self, buckets=10):
+        return Stats(self, buckets)
+
+
     def rename(self, new_attrs):
         assert len(new_attrs) == len(self.attrs)
         return Relation(new_attrs, self.tuples)
@@ -67,15 +110,14 @@ class Relation:
         assert set(attrs) <= set(self.attrs)
 
         ixs = [self.attrs.index(a) for a in attrs]
-        new_tuples = [[t[ix] for ix in ixs] for t in self.tuples]
+        new_tuples = (tuple(t[ix] for ix in ixs) for t in self.tuples)
         return Relation(attrs, new_tuples)
 
 
     def select(self, predicate):
-        dicts = [dict(zip(self.attrs, t)) for t in self.tuples]
-        selected_dicts = [d for d in dicts if predicate(d)]
-        selected_tuples = {tuple(d[k] for k in self.attrs) for d in selected_dicts}
-        return Relation(self.attrs, selected_tuples)
+        attrs = self.attrs
+        selected_tuples = (t for t in self.tuples if predicate(dict(zip(attrs, t))))
+        return Relation(attrs, selected_tuples)
 
 
     def group_by(self, grouping_attrs, aggregations):
@@ -144,39 +186,103 @@ def max_(attr):
 
 
 
-def cross(rel1, rel2):
+# The number of tuples in each batch yielded by batches().
+BATCH_SIZE = 4096
+
+
+def batches(tuples, size=BATCH_SIZE):
+    # Yields lists of up to size tuples from tuples, which may be any
+    # iterable, until it is exhausted.
+    tuples = iter(tuples)
+    while True:
+        batch = list(islice(tuples, size))
+        if not batch:
+            return
+        yield batch
+
+
+# The stream_* functions return (attrs, tuples), where tuples is an iterator
+# over the result of the corresponding operator.  Since relations never contain
+# duplicate tuples, neither do these results, so they can be consumed a batch
+# at a time (eg with batches()) without the whole result ever being held in
+# memory.  The operators themselves are Relation(*stream_...(rel1, rel2)).
+
+
+def stream_cross(rel1, rel2):
     assert not set(rel1.attrs) & set(rel2.attrs)
 
     new_attrs = rel1.attrs + rel2.attrs
-    new_tuples = [t1 + t2 for t1 in rel1.tuples for t2 in rel2.tuples]
-    return Relation(new_attrs, new_tuples)
+    new_tuples = (t1 + t2 for t1 in rel1.tuples for t2 in rel2.tuples)
+    return new_attrs, new_tuples
 
 
-def natural_join(rel1, rel2):
-    common_attrs = set(rel1.attrs) & set(rel2.attrs)
+def cross(rel1, rel2):
+    return Relation(*stream_cross(rel1, rel2))
+
+
+def hash_join(rel1, rel2, attr_pairs, rel2_attrs):
+    # Yields t1 + t2' for every pair of tuples where t1[attr1] == t2[attr2] for
+    # each (attr1, attr2) in attr_pairs, and where t2' is t2 projected onto
+    # rel2_attrs.  Only rel2 is held in memory (as a hash table keyed on the
+    # join attributes), so we never build the full cross product.
+    ixs1 = [rel1.attrs.index(attr1) for attr1, _ in attr_pairs]
+    ixs2 = [rel2.attrs.index(attr2) for _, attr2 in attr_pairs]
+    out_ixs2 = [rel2.attrs.index(attr) for attr in rel2_attrs]
+
+    buckets = defaultdict(list)
+    for t2 in rel2.tuples:
+        key = tuple(t2[ix] for ix in ixs2)
+        buckets[key].append(tuple(t2[ix] for ix in out_ixs2))
+
+    for t1 in rel1.tuples:
+        key = tuple(t1[ix] for ix in ixs1)
+        for t2 in buckets.get(key, ()):
+            yield t1 + t2
+
+
+def stream_natural_join(rel1, rel2):
+    common_attrs = [attr for attr in rel1.attrs if attr in rel2.attrs]
     assert common_attrs
 
-    rel1a_attrs = [(1, attr) for attr in rel1.attrs]
-    rel2a_attrs = [(2, attr) for attr in rel2.attrs]
-    rel2a_only_attrs = [attr for attr in rel2a_attrs if attr[1] not in common_attrs]
-    joined_attrs = rel1a_attrs + rel2a_only_attrs
-    renamed_attrs = [attr[1] for attr in joined_attrs]
+    rel2_only_attrs = [attr for attr in rel2.attrs if attr not in common_attrs]
+    joined_attrs = rel1.attrs + tuple(rel2_only_attrs)
 
-    rel1a = rel1.rename(rel1a_attrs)
-    rel2a = rel2.rename(rel2a_attrs)
+    attr_pairs = [(attr, attr) for attr in common_attrs]
+    new_tuples = hash_join(rel1, rel2, attr_pairs, rel2_only_attrs)
+    return joined_attrs, new_tuples
 
-    cross_rel = cross(rel1a, rel2a)
 
-    predicate = and_(*[eq(F((1, attr)), F((2, attr))) for attr in common_attrs])
+def natural_join(rel1, rel2):
+    return Relation(*stream_natural_join(rel1, rel2))
 
-    join_rel = cross_rel.select(predicate)
-    return join_rel.project(joined_attrs).rename(renamed_attrs)
+
+def stream_inner_join(rel1, rel2, *attr_pairs):
+    assert not set(rel1.attrs) & set(rel2.attrs)
+
+    new_attrs = rel1.attrs + rel2.attrs
+
+    # Pairs with an attr from each relation are used to hash join, whichever
+    # way round they are given.  Pairs with both attrs from the same relation
+    # are applied as a filter on the result.
+    key_pairs = []
+    filter_ixs = []
+    for attr1, attr2 in attr_pairs:
+        if attr1 in rel1.attrs and attr2 in rel2.attrs:
+            key_pairs.append((attr1, attr2))
+        elif attr2 in rel1.attrs and attr1 in rel2.attrs:
+            key_pairs.append((attr2, attr1))
+        else:
+            filter_ixs.append((new_attrs.index(attr1), new_attrs.index(attr2)))
+
+    new_tuples = hash_join(rel1, rel2, key_pairs, rel2.attrs)
+    if filter_ixs:
+        new_tuples = (t for t in new_tuples if all(t[ix1] == t[ix2] for ix1, ix2 in filter_ixs))
+
+    return new_attrs, new_tuples
 
 
 def inner_join(rel1, rel2, *attr_pairs):
-    cross_rel = cross(rel1, rel2)
-    predicate = and_(*[eq(F(attr1), F(attr2)) for attr1, attr2 in attr_pairs])
-    return cross_rel.select(predicate)
+    return Relation(*stream_inner_join(rel1, rel2, *attr_pairs))
 
 
 
@@ -201,6 +307,41 @@ def intersection(rel1, rel2):
     return Relation(rel1.attrs, new_tuples)
 
 
+# The number of tuples handled per call to the executor by the async API.
+ASYNC_BATCH_SIZE = 4096
+
+
+async def run_async(fn, *args, executor=None, **kwargs):
+    # Runs fn(*args, **kwargs) in executor, or in the event loop's default
+    # executor if executor is None, so that the event loop is not blocked.
+    # For instance, await run_async(natural_join, rel1, rel2).
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(fn, *args, **kwargs))
+
+
+def select_batch(attrs, predicate, batch):
+    return [t for t in batch if predicate(dict(zip(attrs, t)))]
+
+
+async def select_async(rel, predicate, executor=None, batch_size=ASYNC_BATCH_SIZE):
+    # Like rel.select(predicate), but runs batch_size tuples at a time in
+    # executor.  If the calling task is cancelled, no further batches are run.
+    if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+        try:
+            pickle.dumps(predicate)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            raise TypeError(
+                'predicate must be picklable to run in a process pool: build it '
+                'from the comparators with and_, or_ and not_, not from lambdas'
+            ) from e
+
+    selected = []
+    for batch in batches(rel.tuples, batch_size):
+        selected += await run_async(select_batch, rel.attrs, predicate, batch, executor=executor)
+
+    return Relation(rel.attrs, selected)
+
+
 comparators = {
     'exact': lambda lhs, rhs: lhs == rhs,
     'iexact': lambda lhs, rhs: lhs.lower() == rhs.lower(),
@@ -220,104 +361,823 @@ comparators = {
 }
 
 
-def build_predicate_fn(fn):
-    def predicate_fn(lhs, rhs):
-        def predicate(record):
-            if isinstance(lhs, dict):
-                lhsv = record[lhs['field']]
-            else:
-                lhsv = lhs
+# Versions of the case-insensitive comparators that expect rhs to be
+# lowercased already.  These are used when rhs is a value rather than a field,
+# so that it is only lowercased once rather than once per record.
+lowered_rhs_comparators = {
+    'iexact': lambda lhs, rhs: lhs.lower() == rhs,
+    'icontains': lambda lhs, rhs: rhs in lhs.lower(),
+    'istartswith': lambda lhs, rhs: lhs.lower().startswith(rhs),
+    'iendswith': lambda lhs, rhs: lhs.lower().endswith(rhs),
+}
 
-            if isinstance(rhs, dict):
-                rhsv = record[rhs['field']]
-            else:
-                rhsv = rhs
 
-            return fn(lhsv, rhsv)
+class Comparison:
+    # A predicate that holds for a record when comparators[op](lhs, rhs) does,
+    # where lhs and rhs are each either a value or a field (see F).  Unlike a
+    # closure, a Comparison can be pickled, so it can be sent to a process
+    # pool.
+    def __init__(self, op, lhs, rhs):
+        self.op = op
+        self.args = (lhs, rhs)
+
+        if isinstance(rhs, str) and op in lowered_rhs_comparators:
+            self.compare = lowered_rhs_comparators[op]
+            self.rhs_value = rhs.lower()
+        else:
+            self.compare = comparators[op]
+            self.rhs_value = rhs
+
+        # Comparing a field with a value is by far the most common case, so we
+        # don't make any other decisions per record for it.
+        self.field_with_value = isinstance(lhs, dict) and not isinstance(rhs, dict)
+
+
+    def __call__(self, record):
+        lhs, rhs = self.args
+
+        if self.field_with_value:
+            return self.compare(record[lhs['field']], self.rhs_value)
+
+        if isinstance(lhs, dict):
+            lhsv = record[lhs['field']]
+        else:
+            lhsv = lhs
+
+        if isinstance(rhs, dict):
+            rhsv = record[rhs['field']]
+        else:
+            rhsv = self.rhs_value
+
+        return self.compare(lhsv, rhsv)
+
 
-        return predicate
+    def __reduce__(self):
+        # The comparators are lambdas, which can't be pickled, so we let
+        # __init__ look them up again.
+        return (Comparison, (self.op,) + self.args)
+
+
+def build_predicate_fn(name):
+    def predicate_fn(lhs, rhs):
+        return Comparison(name, lhs, rhs)
     return predicate_fn
 
 
 
 
-for key, fn in comparators.items():
-    locals()[key] = build_predicate_fn(fn)
+for key in comparators:
+    locals()[key] = build_predicate_fn(key)
 
 
 eq = exact
 
 
+class Compound:
+    # A predicate combining the predicates in args with and, or or not.
+    def __init__(self, op, args):
+        self.op = op
+        self.args = tuple(args)
+
+
+    def __call__(self, record):
+        if self.op == 'and':
+            return all(p(record) for p in self.args)
+        if self.op == 'or':
+            return any(p(record) for p in self.args)
+        return not self.args[0](record)
+
+
 def and_(*ps):
-    return lambda record: all(p(record) for p in ps)
+    return Compound('and', ps)
 
 
 def or_(*ps):
-    return lambda record: any(p(record) for p in ps)
+    return Compound('or', ps)
 
 
 def not_(p):
-    return lambda record: not p(record)
+    return Compound('not', [p])
 
 
 def F(fieldname):
     return {'field': fieldname}
 
 
+# The selectivity assumed for predicates we know nothing about.
+DEFAULT_SELECTIVITY = 0.1
+
+
+class ColumnStats:
+    # Stats are never modified in place: derive() returns new ones.
+    def __init__(self, values, buckets=10):
+        self.count = len(values)
+        self.counts = Counter(values)
+        self.distinct = len(self.counts)
+        self.buckets = buckets
+
+        # The min, max and histogram only describe the values that can be
+        # ordered: None is left out, and if the remaining values can't be
+        # compared with each other, only those of the most common type are
+        # kept.
+        ordered = [v for v in values if v is not None]
+        try:
+            ordered.sort()
+        except TypeError:
+            by_type = defaultdict(list)
+            for v in ordered:
+                by_type[type(v)].append(v)
+            try:
+                ordered = sorted(max(by_type.values(), key=len))
+            except TypeError:
+                # Even values of the same type can't be ordered (eg tuples
+                # containing None), so we don't describe the order at all.
+                ordered = []
+
+        self.ordered_count = len(ordered)
+
+        if ordered:
+            self.min = ordered[0]
+            self.max = ordered[-1]
+        else:
+            self.min = self.max = None
+
+        # An equi-depth histogram: roughly (i + 1) / buckets of the ordered
+        # values are less than bounds[i].
+        if ordered:
+            self.bounds = [ordered[i * self.ordered_count // buckets] for i in range(1, buckets)]
+        else:
+            self.bounds = []
+
+
+    def is_ordered(self, value):
+        # Whether value is one of the values described by min, max and the
+        # histogram.
+        if value is None or self.min is None:
+            return False
+        try:
+            self.min <= value
+        except TypeError:
+            return False
+        return True
+
+
+    def derive(self, removed, added):
+        # Returns stats for the column with the values in removed taken out
+        # and those in added put in.  The counts, min and max stay exact, but
+        # the histogram is only rebuilt by a full analyze, so it drifts as
+        # values are added and removed.  Returns None if a full analyze is
+        # needed because the min or max was removed, or because the column had
+        # no ordered values before.
+        stats = copy(self)
+        stats.counts = counts = Counter(self.counts)
+        stats.count = self.count - len(removed) + len(added)
+
+        for v in removed:
+            counts[v] -= 1
+            if not counts[v]:
+                del counts[v]
+            if self.is_ordered(v):
+                stats.ordered_count -= 1
+
+        for v in added:
+            counts[v] += 1
+            if self.is_ordered(v):
+                stats.ordered_count += 1
+                stats.min = min(stats.min, v)
+                stats.max = max(stats.max, v)
+            elif v is not None and self.min is None:
+                return None
+
+        stats.distinct = len(counts)
+
+        if stats.min is not None and (stats.min not in counts or stats.max not in counts):
+            return None
+
+        return stats
+
+
+    def eq_fraction(self, value):
+        if self.count == 0 or value < self.min or value > self.max:
+            return 0.0
+        return 1.0 / self.distinct
+
+
+    def lt_fraction(self, value):
+        # The fraction of all values (not just the ordered ones) less than
+        # value.
+        if self.count == 0 or value <= self.min:
+            return 0.0
+        if value > self.max:
+            fraction = 1.0
+        else:
+            fraction = (bisect_left(self.bounds, value) + 0.5) / self.buckets
+        return fraction * self.ordered_count / self.count
+
+
+    def selectivity(self, op, value):
+        # Estimates the fraction of values v for which comparators[op](v, value)
+        # holds.  If value can't be compared with the column's values, we
+        # don't know anything.
+        if self.count == 0:
+            return 0.0
+
+        if op == 'iexact':
+            return 1.0 / self.distinct
+
+        if self.min is None:
+            return DEFAULT_SELECTIVITY
+
+        try:
+            if op == 'exact':
+                return self.eq_fraction(value)
+            if op == 'lt':
+                return self.lt_fraction(value)
+            if op == 'lte':
+                return min(1.0, self.lt_fraction(value) + self.eq_fraction(value))
+            if op == 'gt':
+                return max(0.0, self.ordered_count / self.count - self.lt_fraction(value) - self.eq_fraction(value))
+            if op == 'gte':
+                return max(0.0, self.ordered_count / self.count - self.lt_fraction(value))
+        except TypeError:
+            return DEFAULT_SELECTIVITY
+
+        return DEFAULT_SELECTIVITY
+
+
+class Stats:
+    def __init__(self, rel, buckets=10):
+        self.attrs = rel.attrs
+        self.row_count = len(rel)
+        self.columns = {}
+        for ix, attr in enumerate(rel.attrs):
+            self.columns[attr] = ColumnStats([t[ix] for t in rel.tuples], buckets)
+
+
+    def derive(self, removed, added):
+        # Returns stats for the relation with the tuples in removed taken out
+        # and those in added put in, or None if they need to be recomputed.
+        # See ColumnStats.derive.
+        stats = copy(self)
+        stats.row_count = self.row_count - len(removed) + len(added)
+        stats.columns = {}
+        for ix, attr in enumerate(self.attrs):
+            column = self.columns[attr].derive([t[ix] for t in removed], [t[ix] for t in added])
+            if column is None:
+                return None
+            stats.columns[attr] = column
+        return stats
+
+
+    def selectivity(self, predicate):
+        # Estimates the fraction of tuples for which predicate holds.  This
+        # only understands predicates built from comparators, and_, or_ and
+        # not_; anything else gets DEFAULT_SELECTIVITY.
+        op = getattr(predicate, 'op', None)
+
+        if op == 'and':
+            s = 1.0
+            for p in predicate.args:
+                s *= self.selectivity(p)
+            return s
+
+        if op == 'or':
+            s = 1.0
+            for p in predicate.args:
+                s *= 1.0 - self.selectivity(p)
+            return 1.0 - s
+
+        if op == 'not':
+            return 1.0 - self.selectivity(predicate.args[0])
+
+        if op not in comparators:
+            return DEFAULT_SELECTIVITY
+
+        lhs, rhs = predicate.args
+        if isinstance(rhs, dict) and not isinstance(lhs, dict):
+            lhs, rhs = rhs, lhs
+            op = flipped_ops.get(op)
+
+        if op is None or isinstance(rhs, dict) or not isinstance(lhs, dict):
+            return DEFAULT_SELECTIVITY
+
+        if lhs['field'] not in self.columns:
+            return DEFAULT_SELECTIVITY
+
+        return self.columns[lhs['field']].selectivity(op, rhs)
+
+
+    def estimate_size(self, predicate):
+        return self.row_count * self.selectivity(predicate)
+
+
+# Maps op to op' such that comparators[op](a, b) == comparators[op'](b, a).
+flipped_ops = {
+    'exact': 'exact',
+    'gt': 'lt',
+    'gte': 'lte',
+    'lt': 'gt',
+    'lte': 'gte',
+}
+
+
+def estimate_join_size(stats1, stats2, *attr_pairs):
+    # Estimates len(inner_join(rel1, rel2, *attr_pairs)) from the stats of
+    # rel1 and rel2, assuming each value of the attr with fewer distinct values
+    # matches some value of the other.
+    size = float(stats1.row_count * stats2.row_count)
+    for attr1, attr2 in attr_pairs:
+        distinct = max(stats1.columns[attr1].distinct, stats2.columns[attr2].distinct, 1)
+        size /= distinct
+    return size
+
+
+def key_range(predicate, attr):
+    # Returns (low, low_inclusive, high, high_inclusive) such that predicate
+    # can only hold for records where low <(=) record[attr] <(=) high.  low and
+    # high are None when unbounded.  The range is worked out from comparators
+    # on attr that must all hold, and is as wide as possible otherwise.
+    op = getattr(predicate, 'op', None)
+
+    if op == 'and':
+        low, low_inclusive, high, high_inclusive = None, True, None, True
+        for p in predicate.args:
+            l, li, h, hi = key_range(p, attr)
+            if l is not None and (low is None or l > low or (l == low and not li)):
+                low, low_inclusive = l, li
+            if h is not None and (high is None or h < high or (h == high and not hi)):
+                high, high_inclusive = h, hi
+        return low, low_inclusive, high, high_inclusive
+
+    if op not in flipped_ops:
+        return None, True, None, True
+
+    lhs, rhs = predicate.args
+    if isinstance(rhs, dict) and not isinstance(lhs, dict):
+        lhs, rhs = rhs, lhs
+        op = flipped_ops[op]
+
+    if not isinstance(lhs, dict) or isinstance(rhs, dict) or lhs['field'] != attr:
+        return None, True, None, True
+
+    if op == 'exact':
+        return rhs, True, rhs, True
+    if op in ['gt', 'gte']:
+        return rhs, op == 'gte', None, True
+    return None, True, rhs, op == 'lte'
+
+
+class ClusterIndex:
+    # The tuples of a relation, sorted by one of its attrs, so that ordered
+    # scans and range scans over that attr don't need to sort anything.
+    # ClusterIndexes are never modified in place.
+    def __init__(self, ix, keys, tuples):
+        self.ix = ix
+        self.keys = keys
+        self.tuples = tuples
+
+
+    @staticmethod
+    def build(rel, attr):
+        ix = rel.attrs.index(attr)
+        tuples = sorted(rel.tuples, key=lambda t: t[ix])
+        return ClusterIndex(ix, [t[ix] for t in tuples], tuples)
+
+
+    def insert(self, t):
+        i = bisect_right(self.keys, t[self.ix])
+        keys = self.keys[:i] + [t[self.ix]] + self.keys[i:]
+        tuples = self.tuples[:i] + [t] + self.tuples[i:]
+        return ClusterIndex(self.ix, keys, tuples)
+
+
+    def retain(self, tuples):
+        kept = [t for t in self.tuples if t in tuples]
+        return ClusterIndex(self.ix, [t[self.ix] for t in kept], kept)
+
+
+    def scan(self, low=None, low_inclusive=True, high=None, high_inclusive=True, reverse=False):
+        if low is None:
+            start = 0
+        elif low_inclusive:
+            start = bisect_left(self.keys, low)
+        else:
+            start = bisect_right(self.keys, low)
+
+        if high is None:
+            stop = len(self.keys)
+        elif high_inclusive:
+            stop = bisect_right(self.keys, high)
+        else:
+            stop = bisect_left(self.keys, high)
+
+        if reverse:
+            return (self.tuples[i] for i in range(stop - 1, start - 1, -1))
+        return (self.tuples[i] for i in range(start, stop))
+
+
+def trigrams(s):
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+# The comparators for which comparators[op](lhs, rhs) can only hold if lhs
+# contains rhs, mapped to whether the comparison ignores case.
+text_ops = {
+    'exact': False,
+    'contains': False,
+    'startswith': False,
+    'endswith': False,
+    'iexact': True,
+    'icontains': True,
+    'istartswith': True,
+    'iendswith': True,
+}
+
+
+class TrigramIndex:
+    # Maps each trigram of the casefolded string values of an attr to the
+    # tuples whose value contains it.  We use casefold() rather than lower()
+    # because, unlike lower(), it maps each character independently of its
+    # neighbours, so if a contains b then a.casefold() contains b.casefold().
+    #
+    # Tuples whose value is not a str are kept in others and are always
+    # candidates, since comparators like contains (ie Python's in) can also
+    # match values such as tuples.
+    #
+    # TrigramIndexes, and their posting sets, are never modified in place.
+    def __init__(self, ix, postings, others):
+        self.ix = ix
+        self.postings = postings
+        self.others = others
+
+
+    @staticmethod
+    def build(rel, attr):
+        ix = rel.attrs.index(attr)
+        postings = defaultdict(set)
+        others = set()
+        for t in rel.tuples:
+            if not isinstance(t[ix], str):
+                others.add(t)
+            for trigram in TrigramIndex.tuple_trigrams(ix, t):
+                postings[trigram].add(t)
+        return TrigramIndex(ix, dict(postings), others)
+
+
+    @staticmethod
+    def tuple_trigrams(ix, t):
+        if isinstance(t[ix], str):
+            return trigrams(t[ix].casefold())
+        return set()
+
+
+    def derive(self, removed, added):
+        # Returns a new index without the tuples in removed and with those in
+        # added.  Only the posting sets that change are copied.
+        by_trigram = defaultdict(lambda: (set(), set()))
+        for t in removed:
+            for trigram in self.tuple_trigrams(self.ix, t):
+                by_trigram[trigram][0].add(t)
+        for t in added:
+            for trigram in self.tuple_trigrams(self.ix, t):
+                by_trigram[trigram][1].add(t)
+
+        postings = dict(self.postings)
+        for trigram, (trigram_removed, trigram_added) in by_trigram.items():
+            posting = (postings.get(trigram, set()) - trigram_removed) | trigram_added
+            if posting:
+                postings[trigram] = posting
+            else:
+                postings.pop(trigram, None)
+
+        others_removed = {t for t in removed if not isinstance(t[self.ix], str)}
+        others_added = {t for t in added if not isinstance(t[self.ix], str)}
+        if others_removed or others_added:
+            others = (self.others - others_removed) | others_added
+        else:
+            others = self.others
+
+        return TrigramIndex(self.ix, postings, others)
+
+
+    def candidates(self, s, ignore_case):
+        # Returns a set of tuples that includes every tuple whose value
+        # contains s, or None if s is too short to narrow things down.
+        if ignore_case:
+            s = s.lower()
+
+        grams = trigrams(s.casefold())
+        if not grams:
+            return None
+
+        postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+        candidates = set(postings[0])
+        for other in postings[1:]:
+            candidates &= other
+        return candidates | self.others
+
+
 class Table:
-    def __init__(self, name, attrs):
+    def __init__(self, name, attrs, cluster_by='id'):
         self.name = name
         self.attrs = attrs
         self.rel = Relation(attrs, set())
         self.last_id = 0
+        self.stats_cache = (None, None)
+
+        # If cluster_by is not None, selections that are ordered by it and
+        # have a limit, or that restrict it to a range, are answered from a
+        # ClusterIndex.  The index is only built when first needed, and is
+        # then kept up to date by insert and delete.
+        assert cluster_by is None or cluster_by in attrs
+        self.cluster_by = cluster_by
+        self.cluster_cache = (None, None)
+
+        # Maps attrs with a TrigramIndex to (rel, index) where index is for
+        # rel.  Indexes are built when first needed, and then kept up to date
+        # by insert, delete and update.
+        self.text_indexes = {}
+
+        # self.rel is never modified in place: writers build a new relation
+        # and then publish it by reassigning self.rel.  So readers, which only
+        # take a snapshot once per operation, always see a consistent snapshot
+        # without having to take the lock.  Writers are serialised by the lock.
+        self.lock = threading.RLock()
+        self.txn_rel = None
+        self.txn_thread = None
 
 
     def get_next_id(self):
-        self.last_id += 1
-        return self.last_id
+        with self.lock:
+            self.last_id += 1
+            return self.last_id
+
+
+    @contextmanager
+    def transaction(self):
+        # Writes inside a transaction are made to self.txn_rel, and published
+        # in one step when the outermost transaction exits.  If a transaction
+        # raises, the writes made inside it are discarded.  Ids allocated in a
+        # discarded transaction are not reused.
+        with self.lock:
+            outermost = self.txn_rel is None
+            if outermost:
+                saved = self.rel
+            else:
+                saved = self.txn_rel
+
+            self.txn_rel = saved
+            self.txn_thread = threading.get_ident()
+
+            try:
+                yield
+                if outermost:
+                    self.rel = self.txn_rel
+            except BaseException:
+                self.txn_rel = saved
+                raise
+            finally:
+                if outermost:
+                    self.txn_thread = None
+                    self.txn_rel = None
+
+
+    def snapshot(self):
+        # Returns the relation that reads should see: the table's published
+        # relation, unless this thread is inside a transaction, in which case
+        # it should see its own writes.  Only the thread holding the lock can
+        # set txn_thread to its own id, so no lock is needed here.
+        if self.txn_thread == threading.get_ident():
+            return self.txn_rel
+        return self.rel
 
 
     def insert(self, record):
         assert set(record) | set(['id']) == set(self.attrs)
         record = copy(record)
-        record['id'] = self.get_next_id()
-        tpl = tuple(record[attr] for attr in self.attrs)
-        self.rel = union(self.rel, Relation(self.attrs, [tpl]))
+        with self.transaction():
+            record['id'] = self.get_next_id()
+            tpl = tuple(record[attr] for attr in self.attrs)
+            rel = union(self.txn_rel, Relation(self.attrs, [tpl]))
+            self.derive_cluster_index(self.txn_rel, rel, lambda index: index.insert(tpl))
+            self.derive_caches(self.txn_rel, rel, [], [tpl])
+            self.txn_rel = rel
         return record['id']
 
 
     def delete(self, predicate):
-        self.rel = self.rel.select(not_(predicate))
+        with self.transaction():
+            old_rel = self.txn_rel
+            rel = old_rel.select(not_(predicate))
+            self.derive_cluster_index(old_rel, rel, lambda index: index.retain(rel.tuples))
+            self.derive_caches(old_rel, rel, old_rel.tuples - rel.tuples, [])
+            self.txn_rel = rel
 
 
     # This will need to be more sophisticated!
     def update(self, predicate, attr, value):
         assert attr in self.attrs
-        to_update = self.rel.select(predicate)
-        to_not_update = self.rel.select(not_(predicate))
-
-        ix = self.attrs.index(attr)
-        updated_tuples = [tpl[:ix] + (value,) + tpl[ix+1:] for tpl in to_update.tuples]
-        updated_rel = Relation(self.attrs, updated_tuples)
-        self.rel = union(updated_rel, to_not_update)
+        with self.transaction():
+            to_update = self.txn_rel.select(predicate)
+            to_not_update = self.txn_rel.select(not_(predicate))
+
+            ix = self.attrs.index(attr)
+            updated_tuples = [tpl[:ix] + (value,) + tpl[ix+1:] for tpl in to_update.tuples]
+            updated_rel = Relation(self.attrs, updated_tuples)
+            rel = union(updated_rel, to_not_update)
+            removed = to_update.tuples - updated_rel.tuples
+            added = updated_rel.tuples - self.txn_rel.tuples
+            self.derive_caches(self.txn_rel, rel, removed, added)
+            self.txn_rel = rel
+
+
+    def derive_caches(self, old_rel, new_rel, removed, added):
+        # new_rel is old_rel without the tuples in removed and with those in
+        # added.  If we have stats or text indexes for old_rel, derive those
+        # for new_rel from them, rather than recomputing them from scratch when
+        # they're next needed.
+        stats_rel, stats = self.stats_cache
+        if stats_rel is old_rel:
+            stats = stats.derive(removed, added)
+            if stats is not None:
+                self.stats_cache = (new_rel, stats)
+
+        for attr, (index_rel, index) in list(self.text_indexes.items()):
+            if index_rel is old_rel and index is not None:
+                self.text_indexes[attr] = (new_rel, index.derive(removed, added))
+
+
+    def analyze(self):
+        # Stats are computed in full the first time they're asked for, and
+        # then derived from the previous snapshot's by each write.
+        rel = self.snapshot()
+        stats_rel, stats = self.stats_cache
+        if stats_rel is not rel:
+            stats = rel.analyze()
+            self.stats_cache = (rel, stats)
+        return stats
 
 
     def __len__(self):
-        return len(self.rel)
+        return len(self.snapshot())
+
+
+    def cluster_index(self, rel):
+        # Returns the ClusterIndex for rel, or None if the values of the
+        # cluster attr can't be sorted (eg because some are None).
+        index_rel, index = self.cluster_cache
+        if index_rel is not rel:
+            try:
+                index = ClusterIndex.build(rel, self.cluster_by)
+            except TypeError:
+                index = None
+            self.cluster_cache = (rel, index)
+        return index
+
+
+    def derive_cluster_index(self, old_rel, new_rel, fn):
+        # If we have an index for old_rel, use fn to derive the index for
+        # new_rel from it.  Otherwise, it will be built when next needed.
+        index_rel, index = self.cluster_cache
+        if index_rel is old_rel and index is not None:
+            try:
+                index = fn(index)
+            except TypeError:
+                index = None
+            self.cluster_cache = (new_rel, index)
 
 
     def select(self, predicate=None, order=None, offset=None, limit=None):
+        rel, predicate = self.plan(self.snapshot(), predicate, order, offset, limit)
         if predicate is not None:
-            rel = self.rel.select(predicate)
+            rel = rel.select(predicate)
+
+        return table_selection(self.name, self.attrs, rel, order, offset, limit)
+
+
+    def plan(self, rel, predicate, order, offset, limit):
+        # Uses the table's indexes to narrow down the tuples of rel that a
+        # selection needs to look at.  Returns (rel, predicate), where
+        # predicate, if not None, still has to be applied to rel.
+        scan = self.cluster_scan(rel, predicate, order, offset, limit)
+        if scan is not None:
+            return Relation(self.attrs, scan), None
+
+        if predicate is not None:
+            candidates = self.text_candidates(rel, predicate)
+            if candidates is not None:
+                return Relation(self.attrs, candidates), predicate
+
+        return rel, predicate
+
+
+    def create_text_index(self, attr):
+        # Lets selections with string comparators (contains, icontains,
+        # startswith, etc) on attr only look at the tuples whose value for
+        # attr shares every trigram with the string being looked for.
+        assert attr in self.attrs
+        self.text_indexes[attr] = (None, None)
+
+
+    def text_index(self, rel, attr):
+        index_rel, index = self.text_indexes[attr]
+        if index_rel is not rel:
+            index = TrigramIndex.build(rel, attr)
+            self.text_indexes[attr] = (rel, index)
+        return index
+
+
+    def text_candidates(self, rel, predicate):
+        # Returns a subset of rel's tuples that includes all those satisfying
+        # predicate, or None if no text index helps.
+        op = getattr(predicate, 'op', None)
+
+        if op == 'and':
+            candidates = None
+            for p in predicate.args:
+                c = self.text_candidates(rel, p)
+                if c is not None:
+                    candidates = c if candidates is None else candidates & c
+            return candidates
+
+        if op not in text_ops:
+            return None
+
+        lhs, rhs = predicate.args
+        if not isinstance(lhs, dict) or lhs['field'] not in self.text_indexes:
+            return None
+
+        if not isinstance(rhs, str):
+            return None
+
+        return self.text_index(rel, lhs['field']).candidates(rhs, text_ops[op])
+
+
+    def cluster_scan(self, rel, predicate, order, offset, limit):
+        # Returns the tuples of rel that satisfy predicate, read from the
+        # cluster index and cut short after offset + limit tuples, or None if
+        # the cluster index doesn't help.
+        if self.cluster_by is None:
+            return None
+
+        if order is not None and [attr for attr, _ in order] != [self.cluster_by]:
+            return None
+
+        if predicate is not None:
+            low, low_inclusive, high, high_inclusive = key_range(predicate, self.cluster_by)
         else:
-            rel = self.rel
+            low, low_inclusive, high, high_inclusive = None, True, None, True
 
-        if order is not None:
-            order = [((self.name, attr), direction) for attr, direction in order]
+        # Without a limit or a range, we'd walk the whole index only for
+        # Selection to sort everything again, which is worse than a plain sort.
+        if limit is None and low is None and high is None:
+            return None
 
-        attrs = [(self.name, attr) for attr in self.attrs]
-        rel = rel.rename(attrs)
-        return Selection(rel, order=order, offset=offset, limit=limit)
+        index = self.cluster_index(rel)
+        if index is None:
+            return None
+
+        reverse = order is not None and order[0][1] == 'desc'
+        try:
+            tuples = index.scan(low, low_inclusive, high, high_inclusive, reverse)
+        except TypeError:
+            # The predicate compares the cluster attr with a value of a
+            # different type, so leave it to the predicate.
+            return None
+
+        if predicate is not None:
+            attrs = self.attrs
+            tuples = (t for t in tuples if predicate(dict(zip(attrs, t))))
+
+        if limit is not None:
+            tuples = islice(tuples, (offset or 0) + limit)
+
+        return tuples
+
+
+    async def select_async(self, predicate=None, order=None, offset=None, limit=None, executor=None):
+        # Planning reads and updates the table's index caches, so it always
+        # runs in a thread of the event loop's default executor.  Everything
+        # after that only needs plain data, so it can go to a process pool.
+        rel = self.snapshot()
+        rel, predicate = await run_async(self.plan, rel, predicate, order, offset, limit)
+        if predicate is not None:
+            rel = await select_async(rel, predicate, executor=executor)
+
+        return await run_async(
+            table_selection, self.name, self.attrs, rel, order, offset, limit,
+            executor=executor
+        )
+
+
+def table_selection(name, attrs, rel, order, offset, limit):
+    # Returns a Selection of rel, which holds tuples from the table with the
+    # given name and attrs.
+    if order is not None:
+        order = [((name, attr), direction) for attr, direction in order]
+
+    rel = rel.rename([(name, attr) for attr in attrs])
+    return Selection(rel, order=order, offset=offset, limit=limit)
 
 
 class InnerJoin:
@@ -325,8 +1185,8 @@ class InnerJoin:
         lhs_attrs = [(lhs.name, attr) for attr in lhs.attrs]
         rhs_attrs = [(rhs.name, attr) for attr in rhs.attrs]
 
-        lhs_rel = lhs.rel.rename(lhs_attrs)
-        rhs_rel = rhs.rel.rename(rhs_attrs)
+        lhs_rel = lhs.snapshot().rename(lhs_attrs)
+        rhs_rel = rhs.snapshot().rename(rhs_attrs)
 
         attr_pairs = [((lhs.name, lhs_attr), (rhs.name, rhs_attr)) for lhs_attr, rhs_attr in attr_pairs]
 
@@ -342,47 +1202,210 @@ class InnerJoin:
         return Selection(rel, order=order, offset=offset, limit=limit)
 
 
+    async def select_async(self, predicate=None, order=None, offset=None, limit=None, executor=None):
+        rel = self.rel
+        if predicate is not None:
+            rel = await select_async(rel, predicate, executor=executor)
+
+        return await run_async(Selection, rel, order=order, offset=offset, limit=limit, executor=executor)
+
+
+def order_key(attrs, order):
+    # Returns (key, reverse) such that sorting by key, reversed if reverse is
+    # True, gives the ordering described by order.  When every attr is sorted
+    # in the same direction we can compare plain tuples; otherwise we fall
+    # back to comparing attr by attr.
+    ixs = []
+    directions = []
+    for attr, direction in order:
+        assert direction in ['asc', 'desc']
+        ixs.append(attrs.index(attr))
+        directions.append(direction)
+
+    if len(set(directions)) == 1:
+        return (lambda t: tuple(t[ix] for ix in ixs)), directions[0] == 'desc'
+
+    def compare(t1, t2):
+        for ix, direction in zip(ixs, directions):
+            if t1[ix] == t2[ix]:
+                continue
+            if (t1[ix] < t2[ix]) == (direction == 'asc'):
+                return -1
+            return 1
+        return 0
+
+    return cmp_to_key(compare), False
+
+
+# Selections with no limit sort up to this many tuples in memory.  Larger ones
+# are sorted in runs of this size, which are written to temporary files and
+# merged as the selection is read.
+SORT_BUFFER_SIZE = 1000000
+
+
+def remove_files(paths):
+    for path in paths:
+        os.remove(path)
+
+
+def read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                return
+            yield from chunk
+
+
+class ExternalSort:
+    # An iterable over tuples sorted by key (in reverse if reverse is True),
+    # skipping the first offset.  Only buffer_size tuples are sorted in memory
+    # at a time: each sorted run is written to a temporary file, and the runs
+    # are merged each time the ExternalSort is iterated over.  The files are
+    # removed when the ExternalSort is garbage collected.
+    def __init__(self, tuples, key, reverse, offset, buffer_size):
+        self.key = key
+        self.reverse = reverse
+        self.offset = offset
+        self.paths = []
+        weakref.finalize(self, remove_files, self.paths)
+
+        for run in batches(tuples, buffer_size):
+            run.sort(key=key, reverse=reverse)
+            fd, path = tempfile.mkstemp(prefix='pyrela-')
+            self.paths.append(path)
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in batches(run):
+                    pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+
+
+    def __iter__(self):
+        runs = [read_run(path) for path in self.paths]
+        merged = heapq.merge(*runs, key=self.key, reverse=self.reverse)
+        return islice(merged, self.offset, None)
+
+
+    def __reduce__(self):
+        # The files belong to this process, so when pickled (eg to send a
+        # Selection back from a process pool) we send the tuples themselves.
+        return (list, (list(self),))
+
+
 class Selection:
-    def __init__(self, rel, order=None, offset=None, limit=None):
+    def __init__(self, rel, order=None, offset=None, limit=None, sort_buffer_size=None):
         if order is None:
             assert offset is None and limit is None
 
         self.attrs = rel.attrs
-        self.tuples = list(rel.tuples)
+        self.alias_ixs_cache = {}
 
-        if order is not None:
-            for attr, direction in order[::-1]:
-                ix = self.attrs.index(attr)
-                assert direction in ['asc', 'desc']
+        if order is None:
+            self.tuples = list(rel.tuples)
+            return
 
-                self.tuples = sorted(
-                    self.tuples,
-                    key=lambda t: t[ix],
-                    reverse=(direction == 'desc')
-                )
+        key, reverse = order_key(self.attrs, order)
 
         if offset is None:
             low = 0
         else:
             low = offset
 
-        if limit is None:
-            high = len(self.tuples)
-        else:
-            high = low + limit
+        if sort_buffer_size is None:
+            sort_buffer_size = SORT_BUFFER_SIZE
 
-        self.tuples = self.tuples[low:high]
+        if limit is None and len(rel.tuples) > sort_buffer_size:
+            self.tuples = ExternalSort(rel.tuples, key, reverse, low, sort_buffer_size)
+        elif limit is None:
+            self.tuples = sorted(rel.tuples, key=key, reverse=reverse)[low:]
+        else:
+            # We only need the first low + limit tuples, so there is no need
+            # to sort everything.
+            if reverse:
+                head = heapq.nlargest(low + limit, rel.tuples, key=key)
+            else:
+                head = heapq.nsmallest(low + limit, rel.tuples, key=key)
+            self.tuples = head[low:]
 
 
     def records(self):
-        return [dict(zip(self.attrs, t)) for t in self.tuples]
+        return list(self.iter_records())
+
+
+    def iter_records(self):
+        attrs = self.attrs
+        for t in self.tuples:
+            yield dict(zip(attrs, t))
 
 
     def records_for_alias(self, alias):
-        # This duplicates .project and .rename.
-        ixs = [ix for ix in range(len(self.attrs)) if self.attrs[ix][0] == alias]
-        new_tuples = [[t[ix] for ix in ixs] for t in self.tuples]
+        return list(self.iter_records_for_alias(alias))
+
+
+    def iter_records_for_alias(self, alias):
+        attrs, ixs = self.alias_ixs(alias)
+        for t in self.tuples:
+            yield dict(zip(attrs, [t[ix] for ix in ixs]))
+
+
+    def alias_ixs(self, alias):
+        # Returns the attrs belonging to alias (without the alias) and their
+        # positions in self.attrs.  These don't change, so we only work them
+        # out once per alias.
+        if alias not in self.alias_ixs_cache:
+            ixs = [ix for ix in range(len(self.attrs)) if self.attrs[ix][0] == alias]
+            attrs = [self.attrs[ix][1] for ix in ixs]
+            self.alias_ixs_cache[alias] = (attrs, ixs)
+        return self.alias_ixs_cache[alias]
 
-        attrs = [attr[1] for attr in self.attrs if attr[0] == alias]
-        return [dict(zip(attrs, t)) for t in new_tuples]
 
+    async def aiter_records(self, alias=None, batch_size=ASYNC_BATCH_SIZE):
+        # Yields records, giving control back to the event loop after every
+        # batch_size records.
+        if alias is None:
+            records = self.iter_records()
+        else:
+            records = self.iter_records_for_alias(alias)
+
+        for i, record in enumerate(records, 1):
+            yield record
+            if i % batch_size == 0:
+                await asyncio.sleep(0)
+
+
+    def output_attrs(self, alias):
+        # Returns the names to write the attrs under, and their positions in
+        # self.attrs.  Without an alias, (alias, attr) pairs are written as
+        # 'alias.attr'.
+        if alias is not None:
+            return self.alias_ixs(alias)
+
+        attrs = []
+        for attr in self.attrs:
+            if isinstance(attr, tuple):
+                attr = '.'.join(str(part) for part in attr)
+            attrs.append(attr)
+        return attrs, range(len(self.attrs))
+
+
+    def write_json(self, f, alias=None, default=str):
+        # Writes the records as a JSON array, one record at a time.  Values
+        # that json can't serialise (eg dates) are passed to default, as with
+        # json.dumps, so that we never stop halfway through the array.
+        attrs, ixs = self.output_attrs(alias)
+
+        f.write('[')
+        for i, t in enumerate(self.tuples):
+            if i:
+                f.write(', ')
+            f.write(json.dumps(dict(zip(attrs, [t[ix] for ix in ixs])), default=default))
+        f.write(']')
+
+
+    def write_csv(self, f, alias=None):
+        attrs, ixs = self.output_attrs(alias)
+
+        writer = csv.writer(f)
+        writer.writerow(attrs)
+        for t in self.tuples:
+            writer.writerow([t[ix] for ix in ixs])
@@ -1,3 +1,11 @@
+import asyncio
+import concurrent.futures
+import datetime
+import io
+import json
+import os
+import pickle
+import threading
 import unittest
 from pyrela import *
 
@@ -31,6 +39,15 @@ class PredicateTests(unittest.TestCase):
         self.assertFalse(predicate({'A': 10, 'B': 11}))
 
 
+    def test_pickle(self):
+        predicate = and_(icontains(F('A'), 'Bc'), not_(eq(F('A'), F('B'))))
+        copied = pickle.loads(pickle.dumps(predicate))
+
+        self.assertTrue(copied({'A': 'abcd', 'B': 'x'}))
+        self.assertFalse(copied({'A': 'abcd', 'B': 'abcd'}))
+        self.assertFalse(copied({'A': 'xyz', 'B': 'x'}))
+
+
     def test_and(self):
         true_p = lambda record: True
         false_p = lambda record: False
@@ -83,6 +100,15 @@ class ComparatorTests(unittest.TestCase):
         self.assertFalse(fn('AAA', 'BBB'))
 
 
+    def test_case_insensitive_predicates(self):
+        self.assertTrue(iexact(F('A'), 'aBc')({'A': 'AbC'}))
+        self.assertTrue(icontains(F('A'), 'Bc')({'A': 'aAbCd'}))
+        self.assertTrue(istartswith(F('A'), 'aB')({'A': 'AbC'}))
+        self.assertTrue(iendswith(F('A'), 'bC')({'A': 'ABC'}))
+        self.assertFalse(icontains(F('A'), 'x')({'A': 'ABC'}))
+        self.assertTrue(icontains('ABC', F('A'))({'A': 'b'}))
+
+
 class AggregatorTests(unittest.TestCase):
     def setUp(self):
         self.group = [{'A': 1}, {'A': 3}, {'A': 6}]
@@ -117,6 +143,128 @@ class AggregatorTests(unittest.TestCase):
         self.assertEqual(6, aggregate(self.group))
 
 
+class StatsTests(unittest.TestCase):
+    def setUp(self):
+        self.rel = Relation(['A', 'B'], [[a, a % 10] for a in range(100)])
+        self.stats = self.rel.analyze()
+
+
+    def test_column_stats(self):
+        column = self.stats.columns['A']
+        self.assertEqual(100, column.count)
+        self.assertEqual(100, column.distinct)
+        self.assertEqual(0, column.min)
+        self.assertEqual(99, column.max)
+        self.assertEqual([10, 20, 30, 40, 50, 60, 70, 80, 90], column.bounds)
+
+
+    def test_selectivity_of_exact(self):
+        self.assertAlmostEqual(0.1, self.stats.selectivity(eq(F('B'), 3)))
+        self.assertEqual(0.0, self.stats.selectivity(eq(F('B'), 30)))
+
+
+    def test_selectivity_of_range(self):
+        self.assertAlmostEqual(0.25, self.stats.selectivity(lt(F('A'), 25)))
+        self.assertAlmostEqual(0.75, self.stats.selectivity(gte(F('A'), 25)))
+        self.assertAlmostEqual(0.25, self.stats.selectivity(gt(25, F('A'))))
+
+
+    def test_selectivity_of_compound_predicates(self):
+        p = eq(F('B'), 3)
+        self.assertAlmostEqual(0.01, self.stats.selectivity(and_(p, p)))
+        self.assertAlmostEqual(0.19, self.stats.selectivity(or_(p, p)))
+        self.assertAlmostEqual(0.9, self.stats.selectivity(not_(p)))
+
+
+    def test_selectivity_of_unknown_predicate(self):
+        self.assertEqual(DEFAULT_SELECTIVITY, self.stats.selectivity(lambda record: True))
+
+
+    def test_column_with_none_and_mixed_types(self):
+        rel = Relation(['A'], [[None], [1], [2], ['x']])
+        column = rel.analyze().columns['A']
+
+        self.assertEqual(4, column.count)
+        self.assertEqual(4, column.distinct)
+        self.assertEqual(2, column.ordered_count)
+        self.assertEqual(1, column.min)
+        self.assertEqual(2, column.max)
+
+
+    def test_column_with_unorderable_values(self):
+        rel = Relation(['A'], [[(1, None)], [(1, 2)]])
+        column = rel.analyze().columns['A']
+
+        self.assertEqual(2, column.count)
+        self.assertEqual(0, column.ordered_count)
+        self.assertIsNone(column.min)
+        self.assertEqual([], column.bounds)
+        self.assertEqual(DEFAULT_SELECTIVITY, rel.analyze().selectivity(lt(F('A'), (1, 3))))
+
+
+    def test_table_with_none_values(self):
+        t = Table('p', ['id', 'name', 'age'])
+        t.insert({'name': None, 'age': None})
+        stats = t.analyze()
+
+        self.assertEqual(1, stats.row_count)
+        self.assertEqual(DEFAULT_SELECTIVITY, stats.selectivity(lt(F('age'), 18)))
+
+
+    def test_selectivity_with_mismatched_type(self):
+        self.assertEqual(DEFAULT_SELECTIVITY, self.stats.selectivity(eq(F('A'), 'x')))
+        self.assertEqual(DEFAULT_SELECTIVITY, self.stats.selectivity(gt(F('A'), None)))
+
+
+    def test_estimate_join_size(self):
+        rel = Relation(['C', 'D'], [[b, b] for b in range(10)])
+        self.assertEqual(100, estimate_join_size(self.stats, rel.analyze(), ('B', 'C')))
+
+
+    def test_table_stats_are_derived_on_writes(self):
+        t = Table('t', ['id', 'A'])
+        for a in [5, 3, 8, 3]:
+            t.insert({'A': a})
+        stats = t.analyze()
+
+        t.insert({'A': 10})
+        t.update(eq(F('A'), 5), 'A', 4)
+        t.delete(eq(F('id'), 2))
+
+        index_rel, derived = t.stats_cache
+        self.assertIs(t.rel, index_rel)
+        self.assertIs(stats.columns['A'].bounds, derived.columns['A'].bounds)
+
+        full = t.rel.analyze()
+        self.assertEqual(full.row_count, derived.row_count)
+        for attr in ['id', 'A']:
+            for name in ['count', 'distinct', 'ordered_count', 'min', 'max', 'counts']:
+                self.assertEqual(
+                    getattr(full.columns[attr], name),
+                    getattr(derived.columns[attr], name)
+                )
+
+
+    def test_table_stats_are_recomputed_when_max_is_deleted(self):
+        t = Table('t', ['id', 'A'])
+        for a in [5, 3, 8]:
+            t.insert({'A': a})
+        t.analyze()
+
+        t.delete(eq(F('A'), 8))
+        self.assertIsNot(t.rel, t.stats_cache[0])
+        self.assertEqual(5, t.analyze().columns['A'].max)
+
+
+    def test_table_stats_are_refreshed_after_writes(self):
+        t = Table('t', ['id', 'A'])
+        t.insert({'A': 1})
+        self.assertEqual(1, t.analyze().row_count)
+
+        t.insert({'A': 2})
+        self.assertEqual(2, t.analyze().row_count)
+
+
 class OperatorTests(unittest.TestCase):
     def setUp(self):
         self.r1 = Relation(['A', 'B'], [[0, 0], [1, 0], [0, 1], [1, 1]])
@@ -125,6 +273,32 @@ class OperatorTests(unittest.TestCase):
         self.r4 = Relation(['A', 'B'], [[3, 4], [5, 6]])
 
 
+    def test_from_generator(self):
+        r = Relation(['A'], ([a] for a in range(2)))
+        self.assertEqual(r, Relation(['A'], [[0], [1]]))
+
+
+    def test_repr(self):
+        r = Relation(['A', 'BB'], [[100, 1]])
+        self.assertEqual('\n A   | BB \n-----+----\n 100 | 1  \n', repr(r))
+
+
+    def test_repr_with_many_tuples(self):
+        r = Relation(['A'], [[a] for a in range(REPR_MAX_ROWS + 5)])
+        lines = repr(r).splitlines()
+
+        self.assertEqual(1 + 2 + REPR_MAX_ROWS + 1, len(lines))
+        self.assertEqual('... ({} rows)'.format(REPR_MAX_ROWS + 5), lines[-1])
+
+
+    def test_to_string_to_file(self):
+        r = Relation(['A'], [[a] for a in range(REPR_MAX_ROWS + 5)])
+        f = io.StringIO()
+        r.to_string(f=f)
+
+        self.assertEqual(3 + REPR_MAX_ROWS + 5, len(f.getvalue().splitlines()))
+
+
     def test_project(self):
         r = Relation(['A'], [[0], [1]])
         self.assertEqual(self.r1.project(['A']), r)
@@ -155,6 +329,31 @@ class OperatorTests(unittest.TestCase):
         self.assertEqual(cross(ra, rb), self.r1)
 
 
+    def test_stream_cross_in_batches(self):
+        ra = Relation(['A'], [[a] for a in range(5)])
+        rb = Relation(['B'], [[b] for b in range(3)])
+
+        attrs, tuples = stream_cross(ra, rb)
+        sizes = []
+        streamed = []
+        for batch in batches(tuples, 4):
+            sizes.append(len(batch))
+            streamed += batch
+
+        self.assertEqual([4, 4, 4, 3], sizes)
+        self.assertEqual(len(streamed), len(set(streamed)))
+        self.assertEqual(cross(ra, rb), Relation(attrs, streamed))
+
+
+    def test_stream_joins(self):
+        r1 = Relation(['A', 'B', 'C'], [[0, 0, 0], [0, 1, 1]])
+        r2 = Relation(['B', 'C', 'D'], [[0, 0, 0], [1, 1, 0]])
+        self.assertEqual(natural_join(r1, r2), Relation(*stream_natural_join(r1, r2)))
+
+        r3 = Relation(['E', 'F'], [[0, 5], [1, 6]])
+        self.assertEqual(inner_join(r1, r3, ('A', 'E')), Relation(*stream_inner_join(r1, r3, ('A', 'E'))))
+
+
     def test_natural_join(self):
         r1 = Relation(['A', 'B', 'C'], [[0, 0, 0], [0, 1, 1]])
         r2 = Relation(['B', 'C', 'D'], [[0, 0, 0], [1, 1, 0]])
@@ -169,6 +368,28 @@ class OperatorTests(unittest.TestCase):
         self.assertEqual(inner_join(r1, r2, ('A', 'D'), ('B', 'E')), rj)
 
 
+    def test_inner_join_with_reversed_attr_pair(self):
+        r1 = Relation(['A', 'B'], [[0, 0], [1, 1]])
+        r2 = Relation(['C', 'D'], [[0, 5], [2, 6]])
+        rj = Relation(['A', 'B', 'C', 'D'], [[0, 0, 0, 5]])
+        self.assertEqual(inner_join(r1, r2, ('C', 'A')), rj)
+
+
+    def test_inner_join_with_attr_pair_from_one_relation(self):
+        r1 = Relation(['A', 'B'], [[0, 0], [0, 1], [1, 1]])
+        r2 = Relation(['C'], [[0], [1]])
+        rj = Relation(['A', 'B', 'C'], [[0, 0, 0], [1, 1, 1]])
+        self.assertEqual(inner_join(r1, r2, ('A', 'B'), ('A', 'C')), rj)
+        self.assertEqual(inner_join(r1, r2, ('A', 'B')), cross(r1, r2).select(eq(F('A'), F('B'))))
+
+
+    def test_inner_join_with_no_attr_pairs(self):
+        ra = Relation(['A'], [[0], [1]])
+        rb = Relation(['B'], [[0], [1]])
+
+        self.assertEqual(inner_join(ra, rb), cross(ra, rb))
+
+
     def test_diff(self):
         r = Relation(['A', 'B'], [[1, 2]])
         self.assertEqual(diff(self.r3, self.r4), r)
@@ -361,6 +582,78 @@ class TableTests(unittest.TestCase):
         self.assertEqual(Relation(['id', 'A'], [[1, 100], [2, 10], [3, 11]]), self.t.rel)
 
 
+    def test_transaction(self):
+        with self.t.transaction():
+            self.t.insert({'A': 12})
+            self.assertEqual(4, len(self.t))
+            self.assertEqual(
+                [{'id': 4, 'A': 12}],
+                self.t.select(eq(F('A'), 12)).records_for_alias('t')
+            )
+
+            self.t.delete(lt(F('A'), 11))
+            self.assertEqual(2, len(self.t))
+            self.assertEqual(3, len(self.t.rel))
+
+        self.assertEqual(Relation(['id', 'A'], [[3, 11], [4, 12]]), self.t.rel)
+
+
+    def test_transaction_is_not_seen_by_other_threads(self):
+        lengths = []
+
+        def read():
+            lengths.append(len(self.t))
+
+        with self.t.transaction():
+            self.t.insert({'A': 12})
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join()
+
+        self.assertEqual([3], lengths)
+        self.assertEqual(4, len(self.t))
+
+
+    def test_transaction_rollback(self):
+        rel = self.t.rel
+
+        with self.assertRaises(ValueError):
+            with self.t.transaction():
+                self.t.insert({'A': 12})
+                raise ValueError
+
+        self.assertEqual(rel, self.t.rel)
+        self.assertEqual(5, self.t.insert({'A': 12}))
+
+
+    def test_nested_transaction_rollback(self):
+        with self.t.transaction():
+            self.t.insert({'A': 12})
+            try:
+                with self.t.transaction():
+                    self.t.delete(lt(F('A'), 100))
+                    raise ValueError
+            except ValueError:
+                pass
+
+        self.assertEqual(4, len(self.t))
+
+
+    def test_concurrent_inserts(self):
+        def insert():
+            for a in range(100):
+                self.t.insert({'A': a})
+
+        threads = [threading.Thread(target=insert) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(403, len(self.t))
+        self.assertEqual(404, self.t.get_next_id())
+
+
     def test_select_with_no_predicate(self):
         selection = self.t.select(order=[('A', 'asc')])
 
@@ -379,6 +672,304 @@ class TableTests(unittest.TestCase):
         )
 
 
+    def test_write_json(self):
+        selection = self.t.select(order=[('A', 'asc')])
+        f = io.StringIO()
+        selection.write_json(f, alias='t')
+
+        self.assertEqual(
+            [{'id': 1, 'A': 9}, {'id': 2, 'A': 10}, {'id': 3, 'A': 11}],
+            json.loads(f.getvalue())
+        )
+
+
+    def test_write_json_with_dates(self):
+        t = Table('t', ['id', 'day'])
+        t.insert({'day': datetime.date(2015, 3, 1)})
+        selection = t.select()
+
+        f = io.StringIO()
+        selection.write_json(f, alias='t')
+        self.assertEqual([{'id': 1, 'day': '2015-03-01'}], json.loads(f.getvalue()))
+
+        f = io.StringIO()
+        selection.write_json(f, alias='t', default=lambda value: value.toordinal())
+        self.assertEqual([{'id': 1, 'day': 735658}], json.loads(f.getvalue()))
+
+
+    def test_write_csv(self):
+        selection = self.t.select(order=[('A', 'asc')])
+        f = io.StringIO()
+        selection.write_csv(f, alias='t')
+
+        self.assertEqual('id,A\r\n1,9\r\n2,10\r\n3,11\r\n', f.getvalue())
+
+
+    def test_write_json_with_no_alias(self):
+        selection = self.t.select(order=[('A', 'asc')], limit=2)
+        f = io.StringIO()
+        selection.write_json(f)
+
+        self.assertEqual(
+            [{'t.id': 1, 't.A': 9}, {'t.id': 2, 't.A': 10}],
+            json.loads(f.getvalue())
+        )
+
+
+    def test_write_csv_with_no_alias(self):
+        selection = self.t.select(order=[('A', 'asc')], limit=1)
+        f = io.StringIO()
+        selection.write_csv(f)
+
+        self.assertEqual('t.id,t.A\r\n1,9\r\n', f.getvalue())
+
+
+class AsyncTests(unittest.TestCase):
+    def setUp(self):
+        self.t = Table('t', ['id', 'A'])
+        for a in range(10):
+            self.t.insert({'A': a})
+
+
+    def test_select_async(self):
+        async def select():
+            selection = await self.t.select_async(lt(F('A'), 3), order=[('A', 'asc')])
+            return [record async for record in selection.aiter_records(alias='t', batch_size=2)]
+
+        self.assertEqual(
+            [{'id': 1, 'A': 0}, {'id': 2, 'A': 1}, {'id': 3, 'A': 2}],
+            asyncio.run(select())
+        )
+
+
+    def test_select_async_in_process_pool(self):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            selection = asyncio.run(
+                self.t.select_async(order=[('id', 'desc')], limit=2, executor=executor)
+            )
+
+        self.assertEqual(
+            [{'id': 10, 'A': 9}, {'id': 9, 'A': 8}],
+            selection.records_for_alias('t')
+        )
+
+
+    def test_filtered_select_async_in_process_pool(self):
+        predicate = and_(lt(F('A'), 5), not_(or_(eq(F('A'), 1), eq(F('A'), 3))))
+        self.assertEqual(predicate.op, pickle.loads(pickle.dumps(predicate)).op)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            selection = asyncio.run(
+                self.t.select_async(predicate, order=[('A', 'asc')], executor=executor)
+            )
+
+        self.assertEqual([0, 2, 4], [record['A'] for record in selection.records_for_alias('t')])
+
+
+    def test_unpicklable_predicate_in_process_pool(self):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            with self.assertRaises(TypeError):
+                asyncio.run(self.t.select_async(lambda record: True, executor=executor))
+
+
+    def test_select_async_uses_cluster_index(self):
+        asyncio.run(self.t.select_async(gt(F('id'), 5), order=[('id', 'asc')], limit=2))
+
+        index_rel, _ = self.t.cluster_cache
+        self.assertIs(self.t.rel, index_rel)
+
+
+    def test_run_async(self):
+        r1 = Relation(['A', 'B'], [[0, 0], [1, 1]])
+        r2 = Relation(['B', 'C'], [[0, 2], [1, 3]])
+
+        computed = asyncio.run(run_async(natural_join, r1, r2))
+        self.assertEqual(natural_join(r1, r2), computed)
+
+
+    def test_cancel_select_async(self):
+        calls = []
+
+        async def select():
+            task = asyncio.current_task()
+            loop = asyncio.get_running_loop()
+
+            def predicate(record):
+                if not calls:
+                    loop.call_soon_threadsafe(task.cancel)
+                calls.append(record)
+                return True
+
+            await select_async(self.t.rel, predicate, batch_size=3)
+
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(select())
+
+        self.assertEqual(3, len(calls))
+
+
+class ClusterTests(unittest.TestCase):
+    def setUp(self):
+        self.t = Table('t', ['id', 'A'])
+        self.u = Table('u', ['id', 'A'], cluster_by=None)
+        for a in range(20):
+            self.t.insert({'A': a % 7})
+            self.u.insert({'A': a % 7})
+
+
+    def assertSameSelection(self, **kwargs):
+        self.assertEqual(
+            self.u.select(**kwargs).records_for_alias('u'),
+            self.t.select(**kwargs).records_for_alias('t')
+        )
+
+
+    def test_unknown_cluster_attr(self):
+        with self.assertRaises(AssertionError):
+            Table('t', ['id', 'A'], cluster_by='B')
+
+
+    def test_key_range(self):
+        self.assertEqual((None, True, None, True), key_range(lt(F('A'), 3), 'id'))
+        self.assertEqual((3, False, None, True), key_range(gt(F('id'), 3), 'id'))
+        self.assertEqual((None, True, 3, True), key_range(gte(3, F('id')), 'id'))
+        self.assertEqual((3, True, 3, True), key_range(eq(F('id'), 3), 'id'))
+        self.assertEqual(
+            (3, False, 8, True),
+            key_range(and_(gte(F('id'), 3), gt(F('id'), 3), lte(F('id'), 8), lt(F('A'), 3)), 'id')
+        )
+
+
+    def test_ordered_pages(self):
+        for direction in ['asc', 'desc']:
+            for offset in [0, 5, 18]:
+                self.assertSameSelection(order=[('id', direction)], offset=offset, limit=5)
+
+
+    def test_ordered_select_with_no_limit(self):
+        self.assertSameSelection(order=[('id', 'desc')])
+        self.assertEqual((None, None), self.t.cluster_cache)
+
+
+    def test_keyset_page_with_predicate(self):
+        self.assertSameSelection(
+            predicate=and_(gt(F('id'), 6), lt(F('A'), 3)),
+            order=[('id', 'asc')],
+            limit=3
+        )
+
+
+    def test_range_with_no_order(self):
+        self.assertEqual(
+            sorted(record['id'] for record in self.t.select(lte(F('id'), 4)).records_for_alias('t')),
+            [1, 2, 3, 4]
+        )
+
+
+    def test_range_with_mismatched_type(self):
+        self.assertEqual([], self.t.select(eq(F('id'), '1')).records())
+        self.assertEqual([], self.t.select(eq(F('id'), '1'), order=[('id', 'asc')], limit=2).records())
+        self.assertEqual([], self.t.select(eq(F('id'), None), order=[('id', 'desc')]).records())
+
+
+    def test_cluster_attr_with_none_values(self):
+        t = Table('t', ['id', 'name'], cluster_by='name')
+        for name in ['x', None, 'y']:
+            t.insert({'name': name})
+
+        self.assertEqual(
+            [{'id': 1, 'name': 'x'}],
+            t.select(eq(F('name'), 'x')).records_for_alias('t')
+        )
+        self.assertEqual((t.rel, None), t.cluster_cache)
+
+
+    def test_index_is_maintained(self):
+        self.t.select(order=[('id', 'asc')], limit=1)
+        self.t.insert({'A': 100})
+        self.t.delete(lt(F('A'), 3))
+
+        index_rel, index = self.t.cluster_cache
+        self.assertIs(self.t.rel, index_rel)
+        self.assertEqual(sorted(self.t.rel.tuples), index.tuples)
+
+
+class TextIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.t = Table('t', ['id', 'name'])
+        for name in ['Margherita', 'Marinara', 'Pepperoni', 'Quattro Formaggi', 'ma']:
+            self.t.insert({'name': name})
+
+        self.t.create_text_index('name')
+
+
+    def names(self, predicate):
+        return sorted(record['name'] for record in self.t.select(predicate).records_for_alias('t'))
+
+
+    def test_trigram_index(self):
+        index = TrigramIndex.build(self.t.rel, 'name')
+        self.assertEqual(2, len(index.candidates('MAR', True)))
+        self.assertIsNone(index.candidates('ma', True))
+
+
+    def test_select(self):
+        self.assertEqual(['Margherita', 'Marinara'], self.names(istartswith(F('name'), 'MAR')))
+        self.assertEqual(['Quattro Formaggi'], self.names(icontains(F('name'), 'FORM')))
+        self.assertEqual([], self.names(contains(F('name'), 'FORM')))
+        self.assertEqual(['Pepperoni'], self.names(and_(endswith(F('name'), 'oni'), gt(F('id'), 2))))
+        self.assertEqual(['Margherita', 'Marinara', 'ma'], self.names(istartswith(F('name'), 'ma')))
+
+
+    def test_index_is_maintained(self):
+        self.assertEqual(['Pepperoni'], self.names(icontains(F('name'), 'pep')))
+        self.t.insert({'name': 'Pepper'})
+        self.t.delete(eq(F('name'), 'Pepperoni'))
+        self.t.update(eq(F('name'), 'Marinara'), 'name', 'Peppered')
+        self.assertEqual(['Pepper', 'Peppered'], self.names(icontains(F('name'), 'pep')))
+        self.assertEqual(['Margherita'], self.names(icontains(F('name'), 'mar')))
+
+        index_rel, index = self.t.text_indexes['name']
+        self.assertIs(self.t.rel, index_rel)
+        self.assertEqual(TrigramIndex.build(self.t.rel, 'name').postings, index.postings)
+
+
+    def test_old_index_is_not_modified(self):
+        self.names(icontains(F('name'), 'pep'))
+        _, index = self.t.text_indexes['name']
+        postings = {trigram: set(posting) for trigram, posting in index.postings.items()}
+
+        self.t.insert({'name': 'Pepper'})
+        self.t.delete(eq(F('name'), 'Pepperoni'))
+        self.assertEqual(postings, index.postings)
+
+
+    def test_non_string_values(self):
+        t = Table('t', ['id', 'tags'])
+        t.insert({'tags': ('pizza', 'pasta')})
+        t.insert({'tags': 'pizzas'})
+        predicate = contains(F('tags'), 'pizza')
+
+        expected = t.select(predicate, order=[('id', 'asc')]).records_for_alias('t')
+        self.assertEqual(2, len(expected))
+
+        t.create_text_index('tags')
+        self.assertEqual(expected, t.select(predicate, order=[('id', 'asc')]).records_for_alias('t'))
+
+        t.insert({'tags': ('pizza',)})
+        t.delete(eq(F('id'), 1))
+        self.assertEqual(
+            [2, 3],
+            sorted(record['id'] for record in t.select(predicate).records_for_alias('t'))
+        )
+        self.assertEqual({(3, ('pizza',))}, t.text_indexes['tags'][1].others)
+
+
+    def test_non_string_value_on_empty_table(self):
+        t = Table('t', ['id', 'name'])
+        self.assertEqual([], t.select(iexact(F('name'), None)).records())
+
+
 class InnerJoinTests(unittest.TestCase):
     def setUp(self):
         t1 = Table('t1', ['id', 'A'])
@@ -416,6 +1007,14 @@ class InnerJoinTests(unittest.TestCase):
         )
 
 
+    def test_select_async(self):
+        selection = asyncio.run(self.j.select_async(gt(F(('t2', 'B')), 19), order=[(('t2', 'id'), 'asc')]))
+        self.assertEqual(
+            self.j.select(gt(F(('t2', 'B')), 19), order=[(('t2', 'id'), 'asc')]).records(),
+            selection.records()
+        )
+
+
 class SelectionTests(unittest.TestCase):
     def setUp(self):
         self.rel = Relation(['A'], [[11], [9], [10]])
@@ -468,6 +1067,47 @@ class SelectionTests(unittest.TestCase):
         )
 
 
+    def test_order_with_limit(self):
+        rel = Relation(['A', 'B', 'C'], [[1, 2, 3], [1, 2, 1], [1, 3, 2], [0, 1, 1]])
+        selection = Selection(rel, order=[('A', 'asc'), ('B', 'desc'), ('C', 'asc')], offset=1, limit=2)
+
+        self.assertEqual(
+            [
+                {'A': 1, 'B': 3, 'C': 2},
+                {'A': 1, 'B': 2, 'C': 1},
+            ],
+            selection.records()
+        )
+
+
+    def test_external_sort(self):
+        rel = Relation(['A', 'B'], [[a % 3, a] for a in range(20)])
+        order = [('A', 'desc'), ('B', 'asc')]
+
+        expected = Selection(rel, order=order, offset=3).records()
+        selection = Selection(rel, order=order, offset=3, sort_buffer_size=4)
+
+        self.assertIsInstance(selection.tuples, ExternalSort)
+        self.assertEqual(5, len(selection.tuples.paths))
+        self.assertEqual(expected, selection.records())
+        self.assertEqual(expected, selection.records())
+        self.assertEqual(expected, pickle.loads(pickle.dumps(selection)).records())
+
+
+    def test_external_sort_removes_files(self):
+        selection = Selection(self.rel, order=[('A', 'asc')], sort_buffer_size=1)
+        paths = list(selection.tuples.paths)
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+
+        del selection
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+
+    def test_desc_with_limit(self):
+        selection = Selection(self.rel, order=[('A', 'desc')], limit=2)
+        self.assertEqual([{'A': 11}, {'A': 10}], selection.records())
+
+
 if __name__ == '__main__':
     unittest.main()
 